@@ -0,0 +1,98 @@
+'''Helpers for running ffmpeg, shared by main.py and formatter/main.py
+
+'''
+
+import asyncio
+import os
+import shutil
+import subprocess
+
+# ffmpeg without the banner, progress output or terminal input, overwriting outputs
+FFMPEG_ARGS = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y']
+# Suffix of files that are still being written, renamed away once complete
+PART_SUFFIX = '.part'
+# Used to pin ffmpeg to its worker's cores before it starts, None if not installed
+TASKSET = shutil.which('taskset')
+
+
+def available_cores() -> int:
+    '''Return the number of cores this process may run on.
+    Unlike os.cpu_count this respects a limited CPU affinity, e.g. under taskset or in a container.
+    Returns:
+        int: The number of usable cores, at least 1.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def plan_workers(workers: int) -> list[tuple[int, set[int] | None]]:
+    '''Divide the available cores between the conversion workers.
+    Args:
+        workers (int): Number of ffmpeg processes running at once.
+    Returns:
+        list: For every worker, the number of threads its ffmpeg processes may use and
+              the cores to pin them to (None if they can't be pinned).
+    '''
+    if not hasattr(os, 'sched_getaffinity'):
+        return [(max(1, available_cores() // workers), None)] * workers
+
+    cores = sorted(os.sched_getaffinity(0))
+    threads, extra = divmod(len(cores), workers)
+    if threads == 0:
+        # More workers than cores, leave the scheduling to the OS
+        return [(1, None)] * workers
+
+    # The cores that don't divide evenly go to the last workers, one each,
+    # and every worker runs one ffmpeg thread per core it owns
+    plan: list[tuple[int, set[int] | None]] = []
+    start = 0
+    for i in range(workers):
+        size = threads + 1 if i >= workers - extra else threads
+        plan.append((size, set(cores[start:start + size])))
+        start += size
+    return plan
+
+
+def _pin_threads(pid: int, cpus: set[int]):
+    '''Pin every thread of a running process to the given cores.
+    Fallback for systems without taskset. Threads started after this call
+    inherit the mask from the thread that creates them.
+    Args:
+        pid (int): The process to pin.
+        cpus (set): The cores to pin it to.
+    '''
+    try:
+        tids = [int(tid) for tid in os.listdir(f'/proc/{pid}/task')]
+    except OSError:
+        tids = [pid]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            pass  # The thread or process already exited
+
+
+async def run(args: list[str], cpus: set[int] | None = None) -> str:
+    '''Run a command without blocking the event loop.
+    Args:
+        args (list): The command and its arguments.
+        cpus (set): Cores to pin the process to, or None to let it run anywhere.
+    Returns:
+        str: The captured stdout of the command.
+    Raises:
+        subprocess.CalledProcessError: If the command exits with a non-zero code.
+    '''
+    command = args
+    if cpus is not None and TASKSET is not None:
+        # Pin before exec, so every thread ffmpeg starts inherits the mask
+        command = [TASKSET, '-c', ','.join(map(str, sorted(cpus))), *args]
+    process = await asyncio.create_subprocess_exec(
+        *command, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    if cpus is not None and TASKSET is None:
+        _pin_threads(process.pid, cpus)
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+    return stdout.decode()
@@ -6,15 +6,26 @@ For now this is only used for .flac -> .wav
 
 '''
 
+import asyncio
 import click
-import ffmpeg
 import logging
 import os
+import subprocess
+import sys
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+# The ffmpeg helpers are shared with main.py in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ffmpeg_utils import FFMPEG_ARGS, PART_SUFFIX, available_cores, plan_workers, run
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Music file extensions and the type they are handled as
+SUFFIX_MAP = {'.flac': 'flac', '.aiff': 'aiff', '.wav': 'wav'}
+
 
 @click.command()
 @click.option('-f', type=str, default=None, help='Path to the folder containing music files. If not provided, user will be prompted.')
@@ -29,8 +40,115 @@ def cli(f: str | None = None):
     main(f)
 
 
+# Maximum number of files per batched ffmpeg call, each one costs an input and an output descriptor
+MAX_BATCH_FILES = 32
+# Keep the argv of a batched ffmpeg call well below the OS limit
+_ARG_LIMIT = os.sysconf('SC_ARG_MAX') // 2 if hasattr(os, 'sysconf') else 32767 // 2
+
+
+async def _convert_one(src: str, dst: str, threads: int, cpus: set[int] | None) -> tuple[str, str, Exception | None]:
+    '''Convert a single .flac file to .wav.
+    The output is written next to dst with PART_SUFFIX and only renamed to dst
+    once it is complete, so an interrupted conversion never looks finished.
+    Errors are returned instead of raised so one bad file doesn't stop the others.
+    Args:
+        src (str): Path to the source file.
+        dst (str): Path to the destination .wav file.
+        threads (int): Number of threads ffmpeg may use for decoding and encoding.
+        cpus (set): Cores to pin ffmpeg to, or None to let it run anywhere.
+    Returns:
+        tuple: The source path, destination path and the error (None on success).
+    '''
+    tmp_dst = dst + PART_SUFFIX
+    try:
+        await run([*FFMPEG_ARGS, '-threads', str(threads), '-i', src,
+                    '-threads', str(threads), '-f', 'wav', tmp_dst], cpus)
+        os.replace(tmp_dst, dst)
+    except (subprocess.CalledProcessError, OSError) as e:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+        return src, dst, e
+    return src, dst, None
+
+
+async def _convert_batch(
+    batch: list[tuple[str, str]], threads: int, cpus: set[int] | None
+) -> list[tuple[str, str, Exception | None]]:
+    '''Convert several .flac files to .wav with a single ffmpeg invocation.
+    Every file becomes its own input and is mapped to its own output, so the
+    ffmpeg startup cost is paid once per batch instead of once per file.
+    If the batch fails, its files are converted one by one to find the culprit.
+    Args:
+        batch (list): (source, destination) path pairs.
+        threads (int): Number of threads ffmpeg may use per input and output.
+        cpus (set): Cores to pin ffmpeg to, or None to let it run anywhere.
+    Returns:
+        list: (source, destination, error) tuples, see _convert_one.
+    '''
+    if len(batch) == 1:
+        return [await _convert_one(*batch[0], threads, cpus)]
+
+    args = list(FFMPEG_ARGS)
+    for src, _ in batch:
+        args += ['-threads', str(threads), '-i', src]
+    for i, (_, dst) in enumerate(batch):
+        # Take the tags from the file's own input, ffmpeg defaults to the first input for every output
+        args += ['-map', f'{i}:a', '-map_metadata', str(i), '-c:a', 'pcm_s16le',
+                 '-threads', str(threads), '-f', 'wav', dst + PART_SUFFIX]
+
+    try:
+        await run(args, cpus)
+        for _, dst in batch:
+            os.replace(dst + PART_SUFFIX, dst)
+    except (subprocess.CalledProcessError, OSError):
+        # Outputs renamed before the failure are complete and simply converted again
+        return [await _convert_one(src, dst, threads, cpus) for src, dst in batch]
+    return [(src, dst, None) for src, dst in batch]
+
+
+async def _convert_all(batches: list[list[tuple[str, str]]], on_result):
+    '''Convert all batches with one long-lived worker per core.
+    The workers take batches from a shared queue until it is empty, so at most
+    one ffmpeg process per core runs at once. Every worker gets its own share
+    of the cores for its ffmpeg processes.
+    Args:
+        batches (list): Batches of (source, destination) path pairs.
+        on_result (callable): Called with (source, destination, error) for each converted file.
+    '''
+    queue: asyncio.Queue[list[tuple[str, str]]] = asyncio.Queue()
+    for batch in batches:
+        queue.put_nowait(batch)
 
+    async def worker(threads: int, cpus: set[int] | None):
+        while not queue.empty():
+            for result in await _convert_batch(queue.get_nowait(), threads, cpus):
+                on_result(*result)
 
+    await asyncio.gather(*(worker(threads, cpus) for threads, cpus in plan_workers(available_cores())))
+
+
+def _chunk_jobs(jobs: list[tuple[str, str]], max_jobs: int) -> list[list[tuple[str, str]]]:
+    '''Split jobs into batches of at most max_jobs files whose ffmpeg argv fits in _ARG_LIMIT.
+    Args:
+        jobs (list): (source, destination) path pairs.
+        max_jobs (int): Maximum number of files per batch.
+    Returns:
+        list: The batches.
+    '''
+    batches: list[list[tuple[str, str]]] = []
+    batch: list[tuple[str, str]] = []
+    size = 0
+    for src, dst in jobs:
+        # '-threads n -i src' plus '-map i:a -map_metadata i -c:a pcm_s16le -threads n -f wav dst.part'
+        job_size = len(src) + len(dst) + 112
+        if batch and (len(batch) >= max_jobs or size + job_size > _ARG_LIMIT):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append((src, dst))
+        size += job_size
+    if batch:
+        batches.append(batch)
+    return batches
 
 
 def main(music_folder: str | None = None):
@@ -47,6 +165,11 @@ def main(music_folder: str | None = None):
         ValueError: If the folder is not a valid directory.
     '''
     
+    # Bind attributes used in the per-file loops to locals
+    _error = logger.error
+    _splitext = os.path.splitext
+    _suffix_kind = SUFFIX_MAP.get
+
     # Get desired folder from user
     if music_folder is None:
         music_folder = input('Enter the path to the folder containing music files: ')
@@ -57,8 +180,16 @@ def main(music_folder: str | None = None):
     
     # Create a subfolder for converted files
     converted_folder = os.path.join(music_folder, 'wav')
-    if not os.path.exists(converted_folder):
+    # List the converted files once instead of checking each file separately
+    try:
+        existing = set(os.listdir(converted_folder))
+    except FileNotFoundError:
         os.makedirs(converted_folder)
+        existing = set()
+    # Remove leftovers of conversions that were interrupted in a previous run
+    for name in [name for name in existing if name.endswith(PART_SUFFIX)]:
+        os.remove(os.path.join(converted_folder, name))
+        existing.discard(name)
 
     # Iterate through files in the folder
     checked_count = 0
@@ -67,33 +198,69 @@ def main(music_folder: str | None = None):
     error_count = 0
     error_files = []
 
-    for filename in os.listdir(music_folder):
-        if filename.endswith('.flac'):
+    # Scan the folder only once, the file count comes from the same pass
+    with os.scandir(music_folder) as it:
+        entries = [(e.name, e.path) for e in it if e.is_file()]
+    file_count = len(entries)
+
+    # Resolve all output paths up front, the separator is known so skip os.path.join
+    flac_entries: list[tuple[str, str, str]] = []
+    for filename, file_path in entries:
+        stem, ext = _splitext(filename)
+        if _suffix_kind(ext.lower()) == 'flac':
+            flac_entries.append((filename, file_path, stem + '.wav'))
+    dsts = [f'{converted_folder}{os.sep}{out_name}' for _, _, out_name in flac_entries]
+
+    def on_result(src: str, dst: str, error: Exception | None):
+        nonlocal converter_count, error_count
+        if error is not None:
+            filename = os.path.basename(src)
+            error_count += 1
+            error_files.append(filename)
+            _error(f'Error converting {filename}: {error}')
+            # ffmpeg only writes to stderr when something went wrong
+            if isinstance(error, subprocess.CalledProcessError) and error.stderr:
+                _error(error.stderr.decode(errors='replace').strip())
+        else:
+            converter_count += 1
+            existing.add(os.path.basename(dst))
+            pbar.set_postfix(converted=converter_count, skipped=skipped_count, refresh=False)
+        pbar.update()
+
+    # Show progress with a single bar instead of logging every file, only errors are logged
+    with logging_redirect_tqdm(), tqdm(total=len(flac_entries), unit='file') as pbar:
+        jobs: list[tuple[str, str]] = []
+        # Every output name and the source that owns it, whether or not the output
+        # already exists, so a colliding source is reported on every run
+        claimed: dict[str, str] = {}
+        for (filename, file_path, out_name), dst in zip(flac_entries, dsts):
             checked_count += 1
-            file_path = os.path.join(music_folder, filename)
+
+            # Files like 't.flac' and 't.FLAC' map to the same output, convert only the first
+            if out_name in claimed:
+                error_count += 1
+                error_files.append(filename)
+                _error(f'Not converting {filename}, {out_name} is already written from {claimed[out_name]}.')
+                pbar.update()
+                continue
+            claimed[out_name] = filename
 
             # Check if converted file already exists
-            if os.path.exists(os.path.join(converted_folder, filename.replace('.flac', '.wav'))):
+            if out_name in existing:
                 skipped_count += 1
-                logger.info(f'Skipping {filename}, already converted.')
+                pbar.update()
                 continue
 
-            # Convert the file from .flac to .wav
-            try:
-                ffmpeg.input(
-                    file_path
-                    ).output(
-                        os.path.join(converted_folder, filename.replace('.flac', '.wav'))
-                            ).run(overwrite_output=True)
-                converter_count += 1
-                logger.info(f'Converted {filename} to {filename.replace(".flac", ".wav")}')
-            except ffmpeg.Error as e:
-                error_count += 1
-                error_files.append(filename)
-                logger.error(f'Error converting {filename}: {e}')                    
-                continue
+            jobs.append((file_path, dst))
+        pbar.set_postfix(converted=converter_count, skipped=skipped_count)
+
+        # Convert the files concurrently, one batched ffmpeg process per core
+        workers = available_cores()
+        batches = _chunk_jobs(jobs, max(1, min(MAX_BATCH_FILES, -(-len(jobs) // workers))))
+        asyncio.run(_convert_all(batches, on_result))
 
     # Log summary of operations
+    logger.info(f'Folder contained {file_count} files.')
     logger.info(f'Checked {checked_count} files.')
     logger.info(f'Converted {converter_count} files.')
     logger.info(f'Skipped {skipped_count} files (already converted).')
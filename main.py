@@ -7,45 +7,270 @@ For now this is only used for .flac -> .wav
 
 '''
 
+import asyncio
 import click
-import ffmpeg
 import logging
 import os
 import shutil
 import subprocess
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+from ffmpeg_utils import FFMPEG_ARGS, PART_SUFFIX, available_cores, plan_workers, run
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, reflinks are skipped there
+    fcntl = None
+
+try:
+    import soundfile as sf
+except ImportError:  # Without libsndfile every file is converted by ffmpeg
+    sf = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Music file extensions and the type they are handled as
+SUFFIX_MAP = {'.flac': 'flac', '.aiff': 'aiff', '.wav': 'wav'}
+# Audio codecs that can be copied into a .wav file without re-encoding.
+# Only 16-bit, since every decoded output is 16-bit PCM as well
+WAV_PCM_CODECS = {'pcm_s16le'}
+# AIFF-C compression types that hold uncompressed PCM, and its byte order
+AIFC_PCM_ENDIANNESS = {b'NONE': 'be', b'twos': 'be', b'sowt': 'le'}
+
+# ioctl request that clones a file's extents (Linux btrfs/XFS reflink)
+FICLONE = 0x40049409
+
 
 @click.command()
 @click.option('-f', type=str, default=None, help='Path to the folder containing music files. If not provided, user will be prompted.')
 @click.option('-r', '--recursive', is_flag=True, help='Recursively convert files in subfolders.')
-def cli(f: str | None = None, recursive: bool = False):
+@click.option('-w', '--workers', type=int, default=None, help='Number of files to convert at once. Defaults to the number of usable CPU cores.')
+def cli(f: str | None = None, recursive: bool = False, workers: int | None = None):
     '''Command line interface for changing file extensions in a given folder.
     Places new files in a subfolder called 'converted'.
     If the folder does not exist, it will be created.
     Args:
         music_folder (str): The path to the folder containing music files.
                             If None, the user will be prompted to enter a folder path.
+        workers (int): Number of files to convert at once, defaults to the number of usable CPU cores.
+    '''
+    main(f, recursive, workers)
+
+def _decode_with_soundfile(src: str, dst: str):
+    '''Decode a file with libsndfile and stream it to a 16-bit PCM .wav file.
+    Tags such as artist and title are carried over to the INFO chunk, like ffmpeg does.
+    Args:
+        src (str): Path to the source file.
+        dst (str): Path to the destination .wav file.
+    '''
+    with sf.SoundFile(src) as infile, sf.SoundFile(
+        dst, 'w', samplerate=infile.samplerate, channels=infile.channels, format='WAV', subtype='PCM_16'
+    ) as outfile:
+        for key, value in infile.copy_metadata().items():
+            setattr(outfile, key, value)
+        for block in infile.blocks(blocksize=65536, dtype='int16'):
+            outfile.write(block)
+
+def _link_or_copy(src: str, dst: str):
+    '''Place a .wav file in the converted folder without copying its data if possible.
+    Tries a hardlink first, then a copy-on-write reflink, then a regular copy.
+    Args:
+        src (str): Path to the source file.
+        dst (str): Path to the destination file.
+    '''
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    tmp_dst = dst + PART_SUFFIX
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as infile, open(tmp_dst, 'wb') as outfile:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            shutil.copystat(src, tmp_dst)
+            os.replace(tmp_dst, dst)
+            return
+        except OSError:
+            # Filesystem doesn't support reflinks, remove the empty output
+            if os.path.exists(tmp_dst):
+                os.remove(tmp_dst)
+
+    shutil.copy2(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+async def _probe_codec(src: str) -> str:
+    '''Return the codec name of the first audio stream of a file.
+    Args:
+        src (str): Path to the source file.
+    Returns:
+        str: The ffprobe codec name, e.g. 'pcm_s16le'.
+    Raises:
+        subprocess.CalledProcessError: If ffprobe can't read the file.
     '''
-    main(f, recursive)
+    output = await run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+         '-show_entries', 'stream=codec_name,sample_fmt', '-of', 'csv=p=0', src]
+    )
+    return output.strip().split(',')[0]
 
-def main(music_folder: str | None = None, recursive: bool = False):
+def _read_aiff_codec(src: str) -> str | None:
+    '''Read the sample format of an AIFF or AIFF-C file from its header.
+    Args:
+        src (str): Path to the source file.
+    Returns:
+        str: The matching ffprobe codec name, e.g. 'pcm_s16le', or None if the header
+             can't be read or doesn't describe plain PCM.
+    '''
+    try:
+        with open(src, 'rb') as f:
+            header = f.read(12)
+            if len(header) < 12 or header[:4] != b'FORM' or header[8:] not in (b'AIFF', b'AIFC'):
+                return None
+            # Walk the chunks until the COMM chunk, which holds the sample format
+            while len(chunk := f.read(8)) == 8:
+                size = int.from_bytes(chunk[4:], 'big')
+                if chunk[:4] == b'COMM':
+                    comm = f.read(size)
+                    break
+                f.seek(size + (size & 1), os.SEEK_CUR)  # Chunks are padded to an even size
+            else:
+                return None
+    except OSError:
+        return None
+
+    if len(comm) < 18:
+        return None
+    sample_size = int.from_bytes(comm[6:8], 'big')
+    # Plain AIFF is always big-endian, AIFF-C names its compression type after the sample rate
+    compression = b'NONE' if header[8:] == b'AIFF' else comm[18:22]
+    endianness = AIFC_PCM_ENDIANNESS.get(compression)
+    if endianness is None or sample_size not in (16, 24, 32):
+        return None
+    return f'pcm_s{sample_size}{endianness}'
+
+async def _can_remux(src: str) -> bool:
+    '''Check whether a file can be copied into a .wav file without decoding.
+    AIFF headers are read directly, ffprobe is only started when they don't give an answer.
+    Args:
+        src (str): Path to the source file.
+    Returns:
+        bool: True if the first audio stream is in WAV_PCM_CODECS.
+    '''
+    kind = SUFFIX_MAP.get(os.path.splitext(src)[1].lower())
+    if kind == 'flac':
+        return False
+    codec = await asyncio.to_thread(_read_aiff_codec, src) if kind == 'aiff' else None
+    if codec is None:
+        try:
+            codec = await _probe_codec(src)
+        except (subprocess.CalledProcessError, OSError):
+            return False
+    return codec in WAV_PCM_CODECS
+
+async def _convert_one(
+    src: str, dst: str, remux: bool, threads: int, cpus: set[int] | None
+) -> tuple[str, str, Exception | None]:
+    '''Convert a single file to .wav.
+    Every output is 16-bit PCM, whatever the bit depth or byte order of the source.
+    Non-FLAC sources that already hold 16-bit little-endian PCM are remuxed by
+    ffmpeg. Everything else is decoded with soundfile in a worker thread when
+    available, falling back to ffmpeg for files libsndfile can't handle.
+    The output is written next to dst with PART_SUFFIX and only renamed to dst
+    once it is complete, so an interrupted conversion never looks finished.
+    Errors are returned instead of raised so one bad file doesn't stop the others.
+    Args:
+        src (str): Path to the source file.
+        dst (str): Path to the destination .wav file.
+        remux (bool): Whether the source can be remuxed, see _can_remux.
+        threads (int): Number of threads ffmpeg may use for decoding and encoding.
+        cpus (set): Cores to pin ffmpeg to, or None to let it run anywhere.
+    Returns:
+        tuple: The source path, destination path and the error (None on success).
+    '''
+    tmp_dst = dst + PART_SUFFIX
+    # Remuxable files skip soundfile, so the output doesn't depend on it being installed
+    if sf is not None and not remux:
+        try:
+            await asyncio.to_thread(_decode_with_soundfile, src, tmp_dst)
+        except Exception:
+            # Any soundfile failure, including a short write, hands the file to ffmpeg
+            if os.path.exists(tmp_dst):
+                os.remove(tmp_dst)
+        else:
+            try:
+                os.replace(tmp_dst, dst)
+            except OSError as e:
+                if os.path.exists(tmp_dst):
+                    os.remove(tmp_dst)
+                return src, dst, e
+            return src, dst, None
+
+    try:
+        if remux:
+            # Already 16-bit little-endian PCM, so remux the samples without decoding
+            args = [*FFMPEG_ARGS, '-i', src, '-c:a', 'copy', '-f', 'wav', tmp_dst]
+        else:
+            # Cap ffmpeg's threads so parallel workers don't oversubscribe the CPU
+            args = [*FFMPEG_ARGS, '-threads', str(threads), '-i', src,
+                    '-threads', str(threads), '-f', 'wav', tmp_dst]
+        await run(args, cpus)
+        os.replace(tmp_dst, dst)
+    except (subprocess.CalledProcessError, OSError) as e:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+        return src, dst, e
+    return src, dst, None
+
+async def _convert_all(jobs: list[tuple[str, str]], on_result, workers: int):
+    '''Convert all jobs with a fixed number of long-lived workers.
+    A producer decides which files can be remuxed ahead of the workers
+    and feeds them through a small bounded queue.
+    Every worker gets its own share of the cores for its ffmpeg processes.
+    Args:
+        jobs (list): (source, destination) path pairs.
+        on_result (callable): Called with (source, destination, error) as each job finishes.
+        workers (int): Number of conversions running at once.
+    '''
+    # One queued job per worker, None tells a worker to stop
+    queue: asyncio.Queue[tuple[str, str, bool] | None] = asyncio.Queue(maxsize=workers)
+
+    async def producer():
+        for src, dst in jobs:
+            await queue.put((src, dst, await _can_remux(src)))
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def worker(threads: int, cpus: set[int] | None):
+        while (job := await queue.get()) is not None:
+            on_result(*await _convert_one(*job, threads, cpus))
+
+    await asyncio.gather(producer(), *(worker(threads, cpus) for threads, cpus in plan_workers(workers)))
+
+def main(music_folder: str | None = None, recursive: bool = False, workers: int | None = None):
     '''Main function to change file extensions in a given folder.
     Places new files in a subfolder called 'converted'.
     If the folder does not exist, it will be created.
     Args:
         music_folder (str): The path to the folder containing music files.
                             If None, the user will be prompted to enter a folder path.
+        workers (int): Number of files to convert at once, defaults to the number of usable CPU cores.
     Returns:
         int: Returns 0 on success.
     Raises:
         FileNotFoundError: If the specified folder does not exist.
-        ValueError: If the folder is not a valid directory.
+        ValueError: If the folder is not a valid directory or workers is less than 1.
     '''
     
+    # Bind attributes used in the per-file loops to locals
+    _error = logger.error
+    _splitext = os.path.splitext
+    _suffix_kind = SUFFIX_MAP.get
+
     if recursive:
         logger.warning('Recursive conversion is not implemented yet. Only the specified folder will be processed.')
 
@@ -57,9 +282,23 @@ def main(music_folder: str | None = None, recursive: bool = False):
         raise FileNotFoundError(f'The folder {music_folder} does not exist.')
     if not os.path.isdir(music_folder):
         raise ValueError(f'The path {music_folder} is not a valid directory.')
+    if workers is None:
+        workers = available_cores()
+    if workers < 1:
+        raise ValueError(f'The number of workers must be at least 1, got {workers}.')
     
+    # Scan the folder once and sort the music files by type
+    with os.scandir(music_folder) as it:
+        entries = [(e.name, e.path) for e in it if e.is_file()]
+    buckets: dict[str, list[tuple[str, str]]] = {'flac': [], 'aiff': [], 'wav': []}
+    for filename, file_path in entries:
+        kind = _suffix_kind(_splitext(filename)[1].lower())
+        if kind is not None:
+            buckets[kind].append((filename, file_path))
+    flac_jobs, aiff_jobs, wav_jobs = buckets['flac'], buckets['aiff'], buckets['wav']
+
     # check if folder contains music files
-    if not any(filename.endswith(('.wav', '.flac', '.aiff')) for filename in os.listdir(music_folder)):
+    if not (flac_jobs or aiff_jobs or wav_jobs):
         logger.warning(f'The folder {music_folder} does not contain any music files (.wav, .flac, .aiff).')
         return 0
 
@@ -67,15 +306,24 @@ def main(music_folder: str | None = None, recursive: bool = False):
     if music_folder.endswith('/'):
         music_folder = music_folder[:-1]
     
+    folder_name = os.path.basename(music_folder)
     logger.info(f'Using folder: {music_folder}')
-    converted_folder = os.path.join(music_folder, f'{os.path.basename(music_folder)}_wav')
+    converted_folder = os.path.join(music_folder, f'{folder_name}_wav')
     logger.info(f'Converted files will be saved in: {converted_folder}')
-    if not os.path.exists(converted_folder):
+    # List the converted files once instead of checking each file separately
+    try:
+        existing = set(os.listdir(converted_folder))
+    except FileNotFoundError:
         os.makedirs(converted_folder)
+        existing = set()
+    # Remove leftovers of conversions that were interrupted in a previous run
+    for name in [name for name in existing if name.endswith(PART_SUFFIX)]:
+        os.remove(os.path.join(converted_folder, name))
+        existing.discard(name)
 
     # Keep stats of the conversion process
 
-    file_count = len(os.listdir(music_folder)) - 1  # Exclude the converted folder itself from the count 
+    file_count = len(entries)  # Files only, subfolders such as the converted folder are not counted
     checked_count   = 0
     copied_count    = 0
     converter_count = 0
@@ -86,64 +334,85 @@ def main(music_folder: str | None = None, recursive: bool = False):
     input('Press Enter to start the conversion process...')
     # todo: recursively do this for all subfolders
 
-    for filename in os.listdir(music_folder):
-        if filename.endswith('.wav'):
-            # Check if .wav file already exists
-            checked_count += 1
-            if os.path.exists(os.path.join(converted_folder, filename)):
-                # If it exists, skip conversion
-                skipped_count += 1
-                logger.info(f'Skipping {filename}, already converted.')
-                continue
-
-            # Copy the .wav file to the converted folder
-            shutil.copy2(
-                os.path.join(music_folder, filename),
-                os.path.join(converted_folder, filename)
-            )
-            copied_count += 1
-            continue
-
-        if filename.endswith('.flac') or filename.endswith('.aiff'):
-            checked_count += 1
-            file_path = os.path.join(music_folder, filename)
-
-            # Check if converted file already exists
-            if os.path.exists(os.path.join(converted_folder, filename.replace('.flac', '.wav'))):
-                skipped_count += 1
-                logger.info(f'Skipping {filename}, already converted.')
-                continue
-
-            # Convert the file from .flac to .wav
-            try:
-                # Use ffmpeg-python for conversion
-                subprocess.call(['ffmpeg', '-i', file_path, os.path.join(converted_folder, filename.replace('.flac', '.wav'))])
-                # ffmpeg.input(
-                    # file_path
-                    # ).output(
-                        # os.path.join(converted_folder, filename.replace('.flac', '.wav'))
-                            # ).run(overwrite_output=True)
-                converter_count += 1
-                logger.info(f'Converted {filename} to {filename.replace(".flac", ".wav")}')
-            except KeyboardInterrupt:
-                print()
-                logger.info('Conversion interrupted by user.')
-                logger.info(f'Folder contained {file_count} files.')
-                logger.info(f'Checked {checked_count} files.')
-                logger.info(f'Copied {copied_count} files.')
-                logger.info(f'Converted {converter_count} files.')
-                logger.info(f'Skipped {skipped_count} files (already converted).')
-                logger.info(f'Encountered {error_count} errors during conversion.')
-                if error_count > 0:
-                    logger.error(f'Files with errors: {", ".join(error_files)}')
-                return 0
-            
-            except ffmpeg.Error as e:
-                error_count += 1
-                error_files.append(filename)
-                logger.error(f'Error converting {filename}: {e}')                    
-                continue
-            
+    # Resolve all output paths up front, the separator is known so skip os.path.join
+    audio_entries = flac_jobs + aiff_jobs
+    out_names = [_splitext(filename)[0] + '.wav' for filename, _ in audio_entries]
+    dsts = [f'{converted_folder}{os.sep}{out_name}' for out_name in out_names]
+    wav_dsts = [f'{converted_folder}{os.sep}{filename}' for filename, _ in wav_jobs]
+
+    def on_result(src: str, dst: str, error: Exception | None):
+        nonlocal converter_count, error_count
+        if error is not None:
+            filename = os.path.basename(src)
+            error_count += 1
+            error_files.append(filename)
+            _error(f'Error converting {filename}: {error}')
+            # ffmpeg only writes to stderr when something went wrong
+            if isinstance(error, subprocess.CalledProcessError) and error.stderr:
+                _error(error.stderr.decode(errors='replace').strip())
+        else:
+            converter_count += 1
+            existing.add(os.path.basename(dst))
+            pbar.set_postfix(converted=converter_count, skipped=skipped_count, refresh=False)
+        pbar.update()
+
+    # Show progress with a single bar instead of logging every file, only errors are logged
+    try:
+        with logging_redirect_tqdm(), tqdm(total=len(wav_jobs) + len(audio_entries), unit='file') as pbar:
+            # Every output name and the source that owns it, .wav files first, whether or not
+            # the output already exists, so a colliding source is reported on every run
+            claimed: dict[str, str] = {filename: filename for filename, _ in wav_jobs}
+            for (filename, file_path), dst in zip(wav_jobs, wav_dsts):
+                # Check if .wav file already exists
+                checked_count += 1
+                if filename in existing:
+                    # If it exists, skip conversion
+                    skipped_count += 1
+                    pbar.update()
+                    continue
+
+                # Link or copy the .wav file to the converted folder
+                _link_or_copy(file_path, dst)
+                copied_count += 1
+                existing.add(filename)
+                pbar.update()
+
+            jobs: list[tuple[str, str]] = []
+            for (filename, file_path), out_name, dst in zip(audio_entries, out_names, dsts):
+                checked_count += 1
+
+                # Files like 't.flac' and 't.aiff' map to the same output, convert only the first
+                if out_name in claimed:
+                    error_count += 1
+                    error_files.append(filename)
+                    _error(f'Not converting {filename}, {out_name} is already written from {claimed[out_name]}.')
+                    pbar.update()
+                    continue
+                claimed[out_name] = filename
+
+                # Check if converted file already exists
+                if out_name in existing:
+                    skipped_count += 1
+                    pbar.update()
+                    continue
+
+                jobs.append((file_path, dst))
+            pbar.set_postfix(converted=converter_count, skipped=skipped_count)
+
+            # Convert the files concurrently, all parallelism is in libsndfile threads and ffmpeg processes
+            asyncio.run(_convert_all(jobs, on_result, workers))
+    except KeyboardInterrupt:
+        print()
+        logger.info('Conversion interrupted by user.')
+        logger.info(f'Folder contained {file_count} files.')
+        logger.info(f'Checked {checked_count} files.')
+        logger.info(f'Copied {copied_count} files.')
+        logger.info(f'Converted {converter_count} files.')
+        logger.info(f'Skipped {skipped_count} files (already converted).')
+        logger.info(f'Encountered {error_count} errors during conversion.')
+        if error_count > 0:
+            logger.error(f'Files with errors: {", ".join(error_files)}')
+        return 0
 
     # Log summary of operations
     print()